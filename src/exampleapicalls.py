@@ -1,7 +1,6 @@
 # Anthropic Claude with web access and unrestricted Python execution
 
-# TODO: trim front of context if it gets too big
-#       context-free self-critique to validate any citations with web search/browsing
+# TODO: context-free self-critique to validate any citations with web search/browsing
 #       get images (and files in general?) back from code execution somehow
 #       comment and clean up
 #       persist python environment and interpreter state across execution tool calls
@@ -10,13 +9,24 @@
 import streamlit as st # type: ignore
 import anthropic # type: ignore
 
-import requests # type: ignore
+import aiohttp # type: ignore
+import ast
+import asyncio
+import collections
+import fcntl
+import hashlib
+import io
 import urllib.parse
-from bs4 import BeautifulSoup # type: ignore
+from lxml import etree, html as lxml_html # type: ignore
+from lxml.html import defs as lxml_defs # type: ignore
 import os
+import pickle
+import re
+import signal
 import subprocess
 import sys
 import tempfile
+import time
 
 # Header information
 st.title("Anthropic Claude with web access and unrestricted Python execution")
@@ -110,39 +120,141 @@ tools = [{
             }
         },
         "required": ["code"]
-    }
+    },
+    # Cache breakpoint: the tool definitions are identical on every call
+    "cache_control": {"type": "ephemeral"}
+}]
+
+# System prompt, sent with a cache breakpoint so it is served from the cache
+SYSTEM_PROMPT = ("You are a helpful assistant with tools for DuckDuckGo web "
+                 "search, reading webpages and executing Python code. Use "
+                 "them when they help answer the user, and cite the URLs "
+                 "of any sources you rely on.")
+system = [{
+    "type": "text",
+    "text": SYSTEM_PROMPT,
+    "cache_control": {"type": "ephemeral"}
 }]
 
-def search_duckduckgo(query: str, num_results: int = 5) -> list:
+# Maximum number of web requests in flight at once
+FETCH_CONCURRENCY = 10
+# Connection pool size and timeouts (seconds) for web requests
+HTTP_POOL_SIZE = 50
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5)
+# Headers sent with every web request
+_DEFAULT_HEADERS = {
+  'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+# Maximum number of bytes downloaded from a single webpage
+MAX_PAGE_BYTES = 2_000_000
+
+# On-disk cache of web tool results (one file per key), how long entries
+# stay fresh (seconds) and the most entries kept
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mcp-fetch")
+RESULT_CACHE_TTL = 600
+RESULT_CACHE_SIZE = 256
+_CACHE_SUFFIX = ".pickle"
+
+def cache_file(key: str) -> str:
+  """Return the path of the cache file holding a key's result."""
+  digest = hashlib.sha256(key.encode()).hexdigest()
+  return os.path.join(RESULT_CACHE_DIR, digest + _CACHE_SUFFIX)
+
+def cache_get(key: str):
+  """Return a cached web tool result if it is still fresh, else None."""
+  try:
+    # Shared lock so a concurrent write is never read half-way
+    with open(os.path.join(RESULT_CACHE_DIR, ".lock"), "a") as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_SH)
+      path = cache_file(key)
+      if time.time() - os.path.getmtime(path) >= RESULT_CACHE_TTL:
+        return None
+      with open(path, "rb") as f:
+        stored_key, value = pickle.load(f)
+  except Exception:
+    # The cache is best-effort; a missing or unreadable entry is a miss
+    return None
+  return value if stored_key == key else None
+
+def cache_set(key: str, value) -> None:
+  """Store a web tool result in the on-disk cache, evicting old entries."""
+  try:
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(RESULT_CACHE_DIR, ".lock"), "a") as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      path = cache_file(key)
+      with open(f"{path}.tmp", "wb") as f:
+        pickle.dump((key, value), f)
+      os.replace(f"{path}.tmp", path)
+
+      # Drop expired entries, then the oldest ones beyond the size limit
+      now = time.time()
+      entries = []
+      for entry in os.scandir(RESULT_CACHE_DIR):
+        if entry.name.endswith(_CACHE_SUFFIX):
+          entries.append((entry.stat().st_mtime, entry.path))
+      entries.sort(reverse=True)
+      for index, (mtime, entry_path) in enumerate(entries):
+        if index >= RESULT_CACHE_SIZE or now - mtime >= RESULT_CACHE_TTL:
+          os.remove(entry_path)
+  except Exception:
+    pass
+
+def run_async(coro):
+  """Run a coroutine to completion on this session's event loop."""
+  # The loop is kept across reruns so the HTTP session bound to it stays usable
+  if "event_loop" not in st.session_state:
+    st.session_state.event_loop = asyncio.new_event_loop()
+  return st.session_state.event_loop.run_until_complete(coro)
+
+async def get_http_session() -> aiohttp.ClientSession:
+  """Return the aiohttp client session shared by this session's fetches."""
+  session = st.session_state.get("http_session")
+  if session is None or session.closed:
+    # Keep-alive connections are pooled and reused across tool calls
+    session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+      timeout=HTTP_TIMEOUT,
+      headers=_DEFAULT_HEADERS
+    )
+    st.session_state.http_session = session
+  return session
+
+# Matches the encoded target URL in a DuckDuckGo redirect link
+_UDDG_RE = re.compile(r"[?&]uddg=([^&]+)")
+
+async def search_duckduckgo(query: str, num_results: int = 5) -> list:
   """Search DuckDuckGo and return results with clean, decoded URLs."""
+  cache_key = f"search:{num_results}:{query}"
+  cached = cache_get(cache_key)
+  if cached is not None:
+    return cached
+
   encoded_query = urllib.parse.quote(query)
   url = f"https://html.duckduckgo.com/html/?q={encoded_query}"
-  headers = {
-      'User-Agent':
-      'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-  }
 
-  response = requests.get(url, headers=headers)
-  soup = BeautifulSoup(response.text, 'html.parser')
+  session = await get_http_session()
+  async with session.get(url) as response:
+    body = await response.read()
+    parser = lxml_html.HTMLParser(encoding=response.charset)
 
   results = []
-  for result in soup.find_all('div', class_='result')[:num_results]:
-    title_elem = result.find('a', class_='result__a')
-    link = title_elem.get('href') if title_elem else None
-    title = title_elem.text if title_elem else None
-    snippet = result.find('a', class_='result__snippet')
-    description = snippet.text if snippet else None
+  result_elems = []
+  if body.strip():
+    tree = lxml_html.document_fromstring(body, parser=parser)
+    result_elems = tree.cssselect('div.result')[:num_results]
+  for result in result_elems:
+    title_elems = result.cssselect('a.result__a')
+    link = title_elems[0].get('href') if title_elems else None
+    title = title_elems[0].text_content() if title_elems else None
+    snippets = result.cssselect('a.result__snippet')
+    description = snippets[0].text_content() if snippets else None
 
     if title and link:
-      # Decode the DuckDuckGo redirect URL
-      if 'duckduckgo.com/l/?uddg=' in link:
-        # Extract the encoded URL and decode it
-        canonical_url = urllib.parse.unquote(link.split('uddg=')[1])
-        # Remove the DuckDuckGo tracking parameter
-        if '&rut=' in canonical_url:
-          canonical_url = canonical_url.split('&rut=')[0]
-      else:
-        canonical_url = link
+      # Decode the DuckDuckGo redirect URL, dropping tracking parameters
+      # such as rut that follow the target
+      uddg = _UDDG_RE.search(link)
+      canonical_url = urllib.parse.unquote_plus(uddg.group(1)) if uddg else link
 
       results.append({
           "title": title,
@@ -150,87 +262,445 @@ def search_duckduckgo(query: str, num_results: int = 5) -> list:
           "description": description
       })
 
+  # An empty list is also what DuckDuckGo's rate-limit page produces
+  if results:
+    cache_set(cache_key, results)
   return results
 
-def read_webpage(url: str) -> str:
-  """Read and extract text content from a webpage."""
-  try:
-    headers = {
-        'User-Agent':
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-    }
-    response = requests.get(url, headers=headers)
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    # Remove unwanted elements
-    for element in soup(["script", "style", "nav", "header", "footer"]):
-      element.decompose()
-
-    # Get text and maintain links with their href URLs
-    for a_tag in soup.find_all('a'):
-      href = a_tag.get('href')
+# Elements dropped from webpage text, and elements that separate words
+_SKIPPED_TAGS = frozenset(["script", "style", "nav", "header", "footer"])
+_BREAK_TAGS = lxml_defs.block_tags | {"article", "aside", "br", "main",
+                                      "section", "title"}
+_WS_RE = re.compile(r"\s+")
+
+def extract_text(root) -> str:
+  """Extract an element's text in one pass, keeping links with their URLs."""
+  out = io.StringIO()
+  walker = etree.iterwalk(root, events=("start", "end", "comment", "pi"))
+  for event, elem in walker:
+    tag = elem.tag
+    if event in ("comment", "pi"):
+      # Only the text following a comment or processing instruction is kept
+      if elem.tail:
+        out.write(elem.tail)
+    elif event == "start":
+      if tag in _SKIPPED_TAGS:
+        walker.skip_subtree()
+        continue
+      if tag in _BREAK_TAGS:
+        out.write(" ")
+      href = elem.get("href") if tag == "a" else None
       if href:
-        a_tag.replace_with(f"[ {a_tag.text} ]( {href} )")
-
-    text = soup.get_text()
-    lines = (line.strip() for line in text.splitlines())
-    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-    text = ' '.join(chunk for chunk in chunks if chunk)
+        out.write(f" [ {elem.text_content()} ]( {href} ) ")
+        walker.skip_subtree()
+      elif elem.text:
+        out.write(elem.text)
+    else:
+      # The end event still fires for skipped subtrees, so their tails are kept
+      if tag in _BREAK_TAGS:
+        out.write(" ")
+      if elem.tail and elem is not root:
+        out.write(elem.tail)
+  return _WS_RE.sub(" ", out.getvalue()).strip()
+
+async def read_webpage(url: str) -> str:
+  """Read and extract text content from a webpage."""
+  cache_key = f"page:{url}"
+  cached = cache_get(cache_key)
+  if cached is not None:
+    return cached
 
-    return text[:300000]  # Truncate to avoid token limits
+  try:
+    session = await get_http_session()
+    async with session.get(url) as response:
+      # Stream the body and stop once the download cap is reached
+      body = bytearray()
+      async for chunk in response.content.iter_chunked(65536):
+        body.extend(chunk)
+        if len(body) >= MAX_PAGE_BYTES:
+          break
+      # Without a declared charset lxml detects it from the page itself
+      parser = lxml_html.HTMLParser(encoding=response.charset)
+      cacheable = response.status == 200
+
+    if not body.strip():
+      return ""
+    root = lxml_html.document_fromstring(bytes(body), parser=parser)
+    body_elem = root.find("body")
+    text = extract_text(body_elem if body_elem is not None else root)
+
+    text = text[:300000]  # Truncate to avoid token limits
+    # Error pages (403, 404, 429, ...) are fetched again next time
+    if cacheable:
+      cache_set(cache_key, text)
+    return text
   except Exception as e:
     return f"Error reading webpage: {str(e)}"
 
-def execute_code(code: str) -> str:
+def with_cache_breakpoint(messages: list) -> list:
+  """Return a copy of messages with a cache breakpoint on the last one."""
+  if not messages:
+    return messages
+  last = messages[-1]
+  content = last["content"]
+  if isinstance(content, str):
+    content = [{"type": "text", "text": content}]
+  # Copy the final block so the stored history is left untouched
+  content = content[:-1] + [{**content[-1], "cache_control": {"type": "ephemeral"}}]
+  return messages[:-1] + [{**last, "content": content}]
+
+# Estimated input tokens above which older turns are summarized, how many
+# recent messages are always kept verbatim, and the model that summarizes
+CONTEXT_TOKEN_LIMIT = 60_000
+CONTEXT_KEEP_RECENT = 6
+SUMMARY_MODEL = "claude-3-haiku-20240307"
+SUMMARY_PREFIX = "[Prior context summary]:"
+# Longest message content kept in the saved history (characters)
+HISTORY_CHAR_LIMIT = 20_000
+
+def estimate_tokens(messages: list) -> int:
+  """Roughly estimate the input tokens of messages (~4 characters each)."""
+  return sum(len(str(message["content"])) for message in messages) // 4
+
+def is_tool_results(message: dict) -> bool:
+  """Return whether a message is a user turn carrying tool results."""
+  content = message["content"]
+  return (message["role"] == "user" and isinstance(content, list)
+          and any(isinstance(block, dict) and block.get("type") == "tool_result"
+                  for block in content))
+
+def trim_context(messages: list, prompt: dict) -> list:
+  """Summarize the middle of a long conversation, keeping its ends verbatim.
+
+  The in-flight user prompt and everything after it are never summarized.
+  """
+  prompt_index = next(index for index, message in enumerate(messages)
+                      if message is prompt)
+  # Tool output the model has already responded to is capped before
+  # measuring; only the prompt and the newest message stay in full
+  messages = [
+    message if index in (prompt_index, len(messages) - 1)
+    else compact_message(message)
+    for index, message in enumerate(messages)
+  ]
+  if estimate_tokens(messages) <= CONTEXT_TOKEN_LIMIT:
+    return messages
+
+  # Don't separate a tool result from the assistant turn that requested it
+  keep_from = max(1, min(len(messages) - CONTEXT_KEEP_RECENT, prompt_index))
+  while keep_from > 1 and is_tool_results(messages[keep_from]):
+    keep_from -= 1
+  if keep_from <= 1:
+    return messages
+
+  middle = messages[1:keep_from]
+  # Summarizing nothing, or only an earlier summary, can't shrink the context
+  if not middle or (len(middle) == 1 and str(middle[0]["content"])
+                    .startswith(SUMMARY_PREFIX)):
+    return messages
+
+  transcript = "\n\n".join(
+    f"{message['role']}: {str(message['content'])[:HISTORY_CHAR_LIMIT]}"
+    for message in middle)
+  summary = client.messages.create(
+    model=SUMMARY_MODEL,
+    max_tokens=1024,
+    temperature=0,
+    messages=[{
+      "role": "user",
+      "content": "Summarize the following tool-call log in at most 500 "
+                 "tokens, keeping facts, URLs and results that may be "
+                 f"needed later:\n\n{transcript}"
+    }]
+  )
+  summary_text = "".join(block.text for block in summary.content
+                         if block.type == "text")
+  return [
+    messages[0],
+    {"role": "user", "content": f"{SUMMARY_PREFIX} {summary_text}"},
+    *messages[keep_from:]
+  ]
+
+def cap_history_text(text: str) -> str:
+  """Truncate text longer than the history limit, noting the truncation."""
+  if len(text) <= HISTORY_CHAR_LIMIT:
+    return text
+  return (text[:HISTORY_CHAR_LIMIT]
+          + " ... [truncated; read the page again for the full content]")
+
+def compact_message(message: dict) -> dict:
+  """Cap a message's long contents, returning it unchanged if none are long."""
+  content = message["content"]
+  if isinstance(content, str):
+    if len(content) > HISTORY_CHAR_LIMIT:
+      return {**message, "content": cap_history_text(content)}
+  elif is_tool_results(message):
+    if any(isinstance(block, dict) and isinstance(block.get("content"), str)
+           and len(block["content"]) > HISTORY_CHAR_LIMIT for block in content):
+      return {**message, "content": [
+        {**block, "content": cap_history_text(block["content"])}
+        if isinstance(block, dict) and isinstance(block.get("content"), str)
+        else block
+        for block in content
+      ]}
+  return message
+
+def compact_history(messages: list) -> list:
+  """Cap long message contents (mostly webpages) before saving the history."""
+  return [compact_message(message) for message in messages]
+
+def code_key(code: str) -> bytes:
+  """Return the key identifying a code snippet in the executed code cache."""
+  return hashlib.blake2b(code.encode(), digest_size=16).digest()
+
+async def run_tools(tool_uses: list, executed_code: dict) -> tuple:
+  """Run the tool calls concurrently, returning their outputs by tool use id.
+
+  Code without a previously cached result is executed. Cached results are
+  returned separately, snapshotted before anything runs, and empty code and
+  unknown tools are left for the caller to answer. A tool that raises has
+  the exception as its output rather than failing the other calls.
+  """
+  semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+  async def dispatch(tool_use):
+    async with semaphore:
+      if tool_use.name == "web_search":
+        return await search_duckduckgo(
+          tool_use.input.get("query"),
+          tool_use.input.get("num_results", 5)
+        )
+      if tool_use.name == "read_webpage":
+        return await read_webpage(tool_use.input.get("url"))
+      return await execute_code(tool_use.input.get("code"))
+
+  runnable = []
+  cached_outputs = {}
+  for tool_use in tool_uses:
+    code = tool_use.input.get("code")
+    if tool_use.name in ("web_search", "read_webpage"):
+      runnable.append(tool_use)
+    elif tool_use.name == "execute_code" and code:
+      if code_key(code) in executed_code:
+        cached_outputs[tool_use.id] = executed_code[code_key(code)]
+      else:
+        runnable.append(tool_use)
+
+  outputs = await asyncio.gather(*(dispatch(t) for t in runnable),
+                                 return_exceptions=True)
+  return ({tool_use.id: output for tool_use, output in zip(runnable, outputs)},
+          cached_outputs)
+
+# Virtual environment shared by all code executions, kept in the user's own
+# cache directory since a shared temp directory lets others plant a venv
+SANDBOX_VENV_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                                "mcp-sandbox-venv")
+SANDBOX_PYTHON = os.path.join(SANDBOX_VENV_DIR, "bin", "python")
+SANDBOX_PIP = os.path.join(SANDBOX_VENV_DIR, "bin", "pip")
+# Written once the venv and its common packages are set up
+SANDBOX_READY_FILE = os.path.join(SANDBOX_VENV_DIR, ".mcp_sandbox_ready")
+# Packages preinstalled into a new sandbox venv
+SANDBOX_COMMON_PACKAGES = ["numpy", "pandas", "requests"]
+# Environment for pip, with a persistent wheel cache shared by all installs
+PIP_ENV = {**os.environ,
+           "PIP_CACHE_DIR": os.path.join(os.path.expanduser("~"), ".cache",
+                                         "mcp-pip")}
+
+def create_sandbox_venv() -> None:
+  """Create the sandbox venv with the common packages, unless it is ready."""
+  # Lock so concurrent sessions don't build the venv at the same time
+  os.makedirs(os.path.dirname(SANDBOX_VENV_DIR), exist_ok=True)
+  with open(f"{SANDBOX_VENV_DIR}.lock", "w") as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    # Venvs without the marker are incomplete or predate the common
+    # packages, so they are rebuilt from scratch
+    if not os.path.exists(SANDBOX_READY_FILE):
+      subprocess.run([sys.executable, "-m", "venv", "--clear",
+                      SANDBOX_VENV_DIR], check=True)
+      # Best effort: anything that fails is still installed on demand
+      subprocess.run([SANDBOX_PIP, "install", *SANDBOX_COMMON_PACKAGES,
+                      "--no-user"], env=PIP_ENV)
+      open(SANDBOX_READY_FILE, "w").close()
+
+async def get_sandbox_venv() -> tuple:
+  """Return the sandbox venv's Python and pip executables, creating it once."""
+  if "sandbox_venv" not in st.session_state:
+    # Building the venv takes a while, so it runs off the event loop
+    await asyncio.to_thread(create_sandbox_venv)
+    st.session_state.sandbox_venv = (SANDBOX_PYTHON, SANDBOX_PIP)
+  return st.session_state.sandbox_venv
+
+# Limits for executed code: CPU seconds, address space and file size in
+# bytes, and wall-clock seconds before the process is killed
+SANDBOX_CPU_SECONDS = 10
+SANDBOX_MEMORY_BYTES = 1024 * 1024 * 1024
+SANDBOX_FILE_BYTES = 100 * 1024 * 1024
+SANDBOX_TIMEOUT = 15
+_pip_lock = asyncio.Lock()
+# Number of distinct code snippets whose results are remembered per session
+EXECUTED_CODE_CACHE_SIZE = 32
+
+# Run with the venv's Python as: -c <this> <cpu> <memory> <file size> <script>.
+# The child applies the limits itself and then runs the script as __main__,
+# since preexec_fn is unsafe in a multi-threaded parent like Streamlit. The
+# hard CPU limit is a second higher so the soft limit's SIGXCPU arrives first
+_SANDBOX_BOOTSTRAP = (
+  "import os, resource, runpy, sys; "
+  "cpu, memory, file_size = map(int, sys.argv[1:4]); "
+  "resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1)); "
+  "resource.setrlimit(resource.RLIMIT_AS, (memory, memory)); "
+  "resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size)); "
+  "sys.argv = sys.argv[4:]; "
+  "sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0])); "
+  "runpy.run_path(sys.argv[0], run_name='__main__')"
+)
+
+def describe_killed(returncode: int) -> str:
+  """Describe a sandboxed run that was killed by a signal."""
+  try:
+    sig = signal.Signals(-returncode)
+  except ValueError:
+    return f"Error executing code: killed by signal {-returncode}"
+  if sig == signal.SIGXCPU:
+    return ("Error executing code: killed (CPU time limit of "
+            f"{SANDBOX_CPU_SECONDS} s exceeded)")
+  return f"Error executing code: killed by {sig.name}"
+
+async def run_process(args: list, timeout=None, **kwargs):
+  """Run a process without blocking the event loop.
+
+  Behaves like subprocess.run with capture_output, text and check set,
+  raising CalledProcessError or TimeoutExpired the same way.
+  """
+  proc = await asyncio.create_subprocess_exec(
+    *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    **kwargs)
+  try:
+    stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+  except asyncio.TimeoutError:
+    proc.kill()
+    await proc.wait()
+    raise subprocess.TimeoutExpired(args, timeout)
+  stdout = stdout.decode(errors="replace")
+  stderr = stderr.decode(errors="replace")
+  if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+  return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+async def run_sandboxed(python_executable: str, code_file: str):
+  """Run a script with the venv's Python under the sandbox limits."""
+  return await run_process(
+    [python_executable, "-c", _SANDBOX_BOOTSTRAP, str(SANDBOX_CPU_SECONDS),
+     str(SANDBOX_MEMORY_BYTES), str(SANDBOX_FILE_BYTES), code_file],
+    timeout=SANDBOX_TIMEOUT)
+
+async def pip_install(pip_executable: str, packages: list):
+  """Install packages into the sandbox venv, one install at a time."""
+  # Concurrent executions share the venv, so their installs don't overlap
+  async with _pip_lock:
+    return await run_process([pip_executable, "install", *packages,
+                              "--no-user"], env=PIP_ENV)
+
+# Matches the module name in a ModuleNotFoundError message
+_MNF_RE = re.compile(r"No module named ['\"]([^'\"]+)['\"]")
+
+# Prints which of its arguments can't be imported, run with the venv's Python
+_FIND_MISSING_MODULES = (
+  "import importlib.util, sys; "
+  "print(' '.join(m for m in sys.argv[1:] "
+  "if importlib.util.find_spec(m) is None))"
+)
+
+async def missing_packages(code: str, python_executable: str) -> list:
+  """Return the top-level modules imported by the code that the venv lacks."""
+  try:
+    tree = ast.parse(code)
+  except SyntaxError:
+    # Let the actual run report the syntax error
+    return []
+
+  modules = set()
+  for node in tree.body:
+    if isinstance(node, ast.Import):
+      modules.update(alias.name.split(".")[0] for alias in node.names)
+    elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+      modules.add(node.module.split(".")[0])
+  if not modules:
+    return []
+
+  # Check them all with a single interpreter start in the venv
+  try:
+    result = await run_process(
+      [python_executable, "-c", _FIND_MISSING_MODULES, *sorted(modules)])
+  except subprocess.CalledProcessError:
+    return []
+  return result.stdout.split()
+
+async def execute_code(code: str) -> str:
   """Execute Python code in a local virtual environment sandbox."""
   try:
+    python_executable, pip_executable = await get_sandbox_venv()
+
     with tempfile.TemporaryDirectory() as temp_dir:
       logs = []
 
-      # Set up a virtual environment in the temporary directory
-      venv_dir = os.path.join(temp_dir, "venv")
-      subprocess.run([sys.executable, "-m", "venv", venv_dir], check=True)
-      logs.append("Virtual environment set up.")
-
-      # Path to the Python executable and pip in the virtual environment
-      python_executable = os.path.join(venv_dir, "bin", "python")
-      pip_executable = os.path.join(venv_dir, "bin", "pip")
-
       # Write the user's code to a temporary file
       code_file = os.path.join(temp_dir, "script.py")
       with open(code_file, "w") as f:
         f.write(code)
 
+      # Install the missing imports in one batch before the first run
+      packages = await missing_packages(code, python_executable)
+      if packages:
+        try:
+          logs.append(f"Installing missing modules: {', '.join(packages)}...")
+          await pip_install(pip_executable, packages)
+          logs.append(f"Modules {', '.join(packages)} installed successfully.")
+        except subprocess.CalledProcessError:
+          # One import name that isn't a package name (PIL, cv2, ...) fails
+          # the whole batch, so install the rest one at a time; the retry
+          # below still handles whatever is left missing
+          for package in packages:
+            try:
+              await pip_install(pip_executable, [package])
+              logs.append(f"Module {package} installed successfully.")
+            except subprocess.CalledProcessError:
+              logs.append(f"Error installing package: {package}")
+
       try:
         # Attempt to execute the code using the virtual environment's Python
-        result = subprocess.run([python_executable, code_file],
-                                capture_output=True, text=True, check=True)
+        result = await run_sandboxed(python_executable, code_file)
         logs.append("Python code executed successfully.")
         logs.append(f"Execution output:\n\n{result.stdout}")
       except subprocess.CalledProcessError as e:
         error_message = e.stderr
+        if e.returncode < 0:
+          # Killed by a signal, e.g. on hitting the CPU time limit
+          logs.append(describe_killed(e.returncode))
         # Check for ModuleNotFoundError and extract the package name
-        if "ModuleNotFoundError" in error_message:
+        elif "ModuleNotFoundError" in error_message:
           # Extract the name of the missing module
           missing_module = extract_missing_module(error_message)
           if missing_module:
             # Attempt to install the missing module
             try:
               logs.append(f"Installing missing module: {missing_module}...")
-              subprocess.run([pip_executable, "install", missing_module,
-                              "--no-user"],
-                             check=True)
+              await pip_install(pip_executable, [missing_module])
               logs.append(f"Module {missing_module} installed successfully.")
 
               # Retry executing the code after installing the missing module
               #logs.append("Retrying code execution...")
-              result = subprocess.run([python_executable, code_file],
-                                      capture_output=True,
-                                      text=True, check=True)
+              result = await run_sandboxed(python_executable, code_file)
               logs.append("Python code executed successfully.")
               logs.append(f"Execution output:\n\n{result.stdout}")
-            except subprocess.CalledProcessError:
-              logs.append(f"Error installing package: {missing_module}")
+            except subprocess.CalledProcessError as retry_error:
+              if retry_error.returncode < 0:
+                logs.append(describe_killed(retry_error.returncode))
+              else:
+                logs.append(f"Error installing package: {missing_module}")
+            except subprocess.TimeoutExpired:
+              logs.append("Error executing code: timed out after "
+                          f"{SANDBOX_TIMEOUT} seconds")
           else:
             logs.append(
                 f"Error: Unable to extract module name from error: {error_message}"
@@ -238,6 +708,9 @@ def execute_code(code: str) -> str:
         else:
           # Log the error message if it is not related to missing modules
           logs.append(f"Error executing code: {error_message}")
+      except subprocess.TimeoutExpired:
+        logs.append("Error executing code: timed out after "
+                    f"{SANDBOX_TIMEOUT} seconds")
 
       return "\n".join(logs)
 
@@ -246,14 +719,11 @@ def execute_code(code: str) -> str:
 
 def extract_missing_module(error_message: str):
   """Extract the missing module name from a ModuleNotFoundError message."""
-  try:
-    # Example error message: "ModuleNotFoundError: No module named 'somepackage'"
-    if "No module named" in error_message:
-      start = error_message.find("'") + 1
-      end = error_message.find("'", start)
-      return error_message[start:end]
-  except Exception:
-    return None
+  # Example error message: "ModuleNotFoundError: No module named 'somepackage'"
+  match = _MNF_RE.search(error_message)
+  if match:
+    # Install the top-level package for submodules like 'package.sub'
+    return match.group(1).split(".")[0]
   return None
 
 # Initialize chat history
@@ -283,35 +753,81 @@ if prompt:
     try:
       iteration_count = 0
       max_iterations = 5
+      cache_read_tokens = 0
       messages = st.session_state.messages[:]
       # Use a local copy to avoid modifying session state during tool use
+      prompt_message = messages[-1]
 
       while iteration_count < max_iterations:
         iteration_count += 1
-        response = client.messages.create(
+        # Keep the input size bounded as tool output piles up
+        messages = trim_context(messages, prompt_message)
+        with client.messages.stream(
           model=model,
           max_tokens=4096,
           temperature=0,
-          messages=messages,  # Full context including hidden messages
-          tools=tools if iteration_count < (max_iterations - 1) else []
-          # Remove tools in final iteration
-        )
+          system=system,
+          # Full context including hidden messages, cached up to the last one
+          messages=with_cache_breakpoint(messages),
+          # Tools stay defined for the tool blocks in the history,
+          # but can't be used in the final iterations
+          tools=tools,
+          tool_choice={"type": "auto"} if iteration_count < (max_iterations - 1)
+                      else {"type": "none"}
+        ) as stream:
+          # Render text as it arrives instead of after the whole response
+          placeholder = st.empty()
+          streamed_text = []
+          for text in stream.text_stream:
+            streamed_text.append(text)
+            placeholder.markdown("".join(streamed_text))
+          response = stream.get_final_message()
+        cache_read_tokens += response.usage.cache_read_input_tokens or 0
+
+        # Keep the structured content so tool results can refer to its tool uses
+        if response.content:
+          messages.append({"role": "assistant", "content": response.content})
+
+        tool_uses = [item for item in response.content if item.type == "tool_use"]
+        executed_code = st.session_state.setdefault(
+          "executed_code", collections.OrderedDict())
+
+        # Show the code that is about to run, since results only come later
+        for tool_use in tool_uses:
+          code = tool_use.input.get("code")
+          if (tool_use.name == "execute_code" and code
+              and code_key(code) not in executed_code):
+            code_display = f"```python\n{code}\n```"
+            st.markdown(f"💻 **Code to be Executed:**\n{code_display}")
+            st.session_state.display_messages.append(
+              {"role": "assistant",
+               "content": f"💻 **Code to be Executed:**\n{code_display}"})
 
-        # Handle initial response if any
+        # Run all requested tools concurrently up front
+        tool_outputs, cached_outputs = run_async(
+          run_tools(tool_uses, executed_code))
+
+        # Handle initial response if any, collecting one result per tool use
+        tool_results = []
         for content_item in response.content:
           if content_item.type == "text":
-            st.markdown(content_item.text)
-            messages.append({"role": "assistant", "content": content_item.text})
+            # Already rendered while streaming
             st.session_state.display_messages.append(
               {"role": "assistant", "content": content_item.text})
 
           elif content_item.type == "tool_use":
-            if content_item.name == "web_search":
-              # Execute search
-              results = search_duckduckgo(
-                content_item.input.get("query"),
-                content_item.input.get("num_results", 5)
-              )
+            if isinstance(tool_outputs.get(content_item.id), BaseException):
+              # Report a failed tool to the model instead of ending the turn
+              error = tool_outputs[content_item.id]
+              result_text = (f"Error running {content_item.name}: "
+                             f"{str(error) or type(error).__name__}")
+              st.markdown(f"⚠️ {result_text}")
+              st.session_state.display_messages.append(
+                {"role": "assistant", "content": f"⚠️ {result_text}"})
+
+            elif content_item.name == "web_search":
+              # Search results were fetched above
+              results = tool_outputs[content_item.id]
 
               # Format search results for display
               search_block = ["🔍 **Search Results**",
@@ -326,18 +842,14 @@ if prompt:
 
               search_results_text = "\n".join(search_block)
               st.markdown(search_results_text)
-              # Append tool output as an informational context
-              messages.append({
-                "role": "user",  # Using user role to provide search result context
-                "content": search_results_text
-              })
+              result_text = search_results_text
               st.session_state.display_messages.append(
                 {"role": "assistant", "content": search_results_text})
 
             elif content_item.name == "read_webpage":
-              # Get webpage content first
+              # Webpage content was fetched above
               url = content_item.input.get("url")
-              content = read_webpage(url)
+              content = tool_outputs[content_item.id]
 
               # Format webpage content for display
               webpage_block = [
@@ -349,36 +861,31 @@ if prompt:
 
               webpage_text = "\n".join(webpage_block)
               st.markdown(webpage_text)
-              # Append tool output as an informational context
-              messages.append({
-                "role": "user",  # User role to provide webpage content context
-                "content": f"Content from {url}: {content}"
-              })
+              result_text = f"Content from {url}: {content}"
               st.session_state.display_messages.append(
                 {"role": "assistant", "content": webpage_text})
 
             elif content_item.name == "execute_code":
               # Get code content to execute
               code = content_item.input.get("code")
-              if code:
-                # Check if the code has already been executed in this session
-                last_executed_code = st.session_state.get("last_executed_code", None)
-                if last_executed_code == code:
-                  # Inform the model that the code was already executed
-                  messages.append({
-                    "role": "user",  # Using user role to inform context
-                    "content": "The specified code has already been executed."
-                  })
+              if not code:
+                result_text = "Error: no code was provided."
+              else:
+                # Code already executed in this session wasn't run again
+                key = code_key(code)
+                if content_item.id in cached_outputs:
+                  # Return the earlier result instead, as most recently used
+                  # again even if storing a new result just evicted it
+                  executed_code[key] = cached_outputs[content_item.id]
+                  executed_code.move_to_end(key)
+                  if len(executed_code) > EXECUTED_CODE_CACHE_SIZE:
+                    executed_code.popitem(last=False)
+                  result_text = ("The specified code has already been executed. "
+                                 "Code Execution Result:\n"
+                                 f"```\n{cached_outputs[content_item.id]}\n```")
                 else:
-                  # Show the code that will be executed
-                  code_display = f"```python\n{code}\n```"
-                  st.markdown(f"💻 **Code to be Executed:**\n{code_display}")
-                  st.session_state.display_messages.append(
-                    {"role": "assistant",
-                     "content": f"💻 **Code to be Executed:**\n{code_display}"})
-
-                  # Execute the code in a local virtual environment sandbox
-                  execution_result = execute_code(code)
+                  # The code was executed in the local venv sandbox above
+                  execution_result = tool_outputs[content_item.id]
 
                   # Format code execution result for display
                   code_execution_block = [
@@ -388,23 +895,35 @@ if prompt:
 
                   code_execution_text = "\n".join(code_execution_block)
                   st.markdown(code_execution_text)
-                  # Append tool output as an informational context
-                  messages.append({
-                    "role": "user",  # Using user role to provide code execution context
-                    "content": code_execution_text
-                  })
+                  result_text = code_execution_text
                   st.session_state.display_messages.append(
                     {"role": "assistant", "content": code_execution_text})
 
-                  # Store the executed code to prevent re-execution
-                  st.session_state.last_executed_code = code
+                  # Store the result to prevent re-execution
+                  executed_code[key] = execution_result
+                  if len(executed_code) > EXECUTED_CODE_CACHE_SIZE:
+                    executed_code.popitem(last=False)
+
+            else:
+              result_text = f"Error: unknown tool {content_item.name}."
+
+            tool_results.append({
+              "type": "tool_result",
+              "tool_use_id": content_item.id,
+              "content": result_text
+            })
 
         # If no tool use was requested, break the loop
-        if not any(item.type == "tool_use" for item in response.content):
+        if not tool_results:
           break
 
-      # Update session state messages with new content
-      st.session_state.messages.extend(messages[len(st.session_state.messages):])
+        # Return all tool results together in a single user turn
+        messages.append({"role": "user", "content": tool_results})
+
+      st.metric("Cached input tokens", cache_read_tokens)
+
+      # Save the possibly trimmed context, with long tool output capped
+      st.session_state.messages = compact_history(messages)
 
     except Exception as e:
       st.error(f"An error occurred: {str(e)}")